@@ -4,39 +4,125 @@ Flask API with SQLAlchemy, JWT Auth, and Collaborative Filtering
 """
 
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from functools import lru_cache, wraps
+import hashlib
+import random
+import sqlite3
+from flask import Flask, abort, g, make_response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required
-from sqlalchemy import func, and_
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
+from sqlalchemy import event, func, and_, case, delete, exists, insert, inspect, lambda_stmt, literal_column, select, text, union_all
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import column_property, object_session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import column, table
+from sqlalchemy.dialects import postgresql, sqlite
 import os
+import uuid
 from dotenv import load_dotenv
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import numpy as np
+import orjson
+from scipy.sparse import csr_matrix
+
+try:
+    from redis.exceptions import RedisError
+    CACHE_BACKEND_ERRORS = (RedisError, OSError)
+except ImportError:  # redis is only needed when REDIS_URL is set
+    CACHE_BACKEND_ERRORS = (OSError,)
 
 # Load environment variables
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, which serializes far faster than json.dumps"""
+    # Keys stay sorted like Flask's default output, so ETags remain stable
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configuration
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///books.db')
+
+# One pooled connection per request; pre-ping drops connections the
+# server has closed instead of failing the request that checks them out,
+# and recycling retires idle ones before server-side timeouts hit them
+engine_options = {'pool_pre_ping': True, 'pool_recycle': 300}
+database_url = make_url(DATABASE_URL)
+if issubclass(database_url.get_dialect().get_pool_class(database_url), QueuePool):
+    # The pool is per worker process: size it to the worker's threads, since
+    # workers x (pool_size + max_overflow) must fit the server's connection limit.
+    # In-memory SQLite gets a single-connection pool that takes neither option
+    engine_options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 4)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 2))
+    })
+
 app.config.update({
-    'SQLALCHEMY_DATABASE_URI': os.getenv('DATABASE_URL', 'sqlite:///books.db'),
+    'SQLALCHEMY_DATABASE_URI': DATABASE_URL,
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'SQLALCHEMY_ENGINE_OPTIONS': engine_options,
     'JWT_SECRET_KEY': os.getenv('JWT_SECRET_KEY', 'your-super-secret-key'),
-    'JWT_ACCESS_TOKEN_EXPIRES': timedelta(hours=1)
+    'JWT_ACCESS_TOKEN_EXPIRES': timedelta(hours=1),
+    # Response cache for hot GET endpoints; shared through Redis when configured
+    'CACHE_TYPE': 'RedisCache' if os.getenv('REDIS_URL') else 'SimpleCache',
+    'CACHE_REDIS_URL': os.getenv('REDIS_URL'),
+    'CACHE_KEY_PREFIX': 'books-api:',
+    'CACHE_DEFAULT_TIMEOUT': 30
 })
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
+password_hasher = PasswordHasher()
+DUMMY_PASSWORD_HASH = password_hasher.hash(os.urandom(16).hex())
+cache = Cache(app)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
+    # Shared Redis counters keep limits correct across workers; set REDIS_URL
+    # in deployment (e.g. redis://localhost:6379/0)
+    storage_uri=os.getenv('REDIS_URL', 'memory://'),
+    key_prefix='books-api',
+    # Keep serving, with per-worker counters, if Redis becomes unreachable
+    in_memory_fallback_enabled=True
+)
+
+# --- SQLite Tuning ---
+# WAL lets readers proceed while a writer commits; the rest trades a little
+# durability on power loss for fewer fsyncs and keeps hot pages in memory
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
 )
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 # --- Models ---
 class Book(db.Model):
     """Book model with basic information"""
@@ -48,7 +134,8 @@ class Book(db.Model):
     genre = db.Column(db.String(50), nullable=False, index=True)
     description = db.Column(db.Text)
     published_year = db.Column(db.Integer)
-    ratings = db.relationship('Rating', backref='book', lazy=True)
+    # lazy='raise': per-object rating loads are the N+1 pattern, query ratings directly
+    ratings = db.relationship('Rating', backref='book', lazy='raise')
 
     def __repr__(self):
         return f"<Book {self.title}>"
@@ -60,68 +147,443 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128))  # In production, use proper hashing
+    password_hash = db.Column(db.String(128))  # Argon2 hash, see verify_password
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    ratings = db.relationship('Rating', backref='user', lazy=True)
+    ratings = db.relationship('Rating', backref='user', lazy='raise')
 
 class Rating(db.Model):
     """Rating model connecting users and books"""
     __tablename__ = 'ratings'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
-    score = db.Column(db.Integer, nullable=False)
+    # active_history loads the old value on assignment, so moving a rating to
+    # another user or book can still refresh the aggregates it left
+    user_id = column_property(
+        db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False), active_history=True
+    )
+    book_id = column_property(
+        db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False), active_history=True
+    )
+    score = db.Column(db.SmallInteger, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __table_args__ = (
         db.UniqueConstraint('user_id', 'book_id', name='unique_user_book_rating'),
+        # The similarity code relies on scores being positive: 0 means unrated there
+        db.CheckConstraint('score BETWEEN 1 AND 5', name='ck_ratings_score_range'),
+        # Covers the per-user (book_id, score) reads of the recommender
+        db.Index('ix_ratings_covering', 'user_id', 'book_id', 'score'),
+        # Covers the per-book AVG/COUNT behind book_stats
+        db.Index('ix_ratings_book_score', 'book_id', 'score'),
     )
 
+class BookStats(db.Model):
+    """Per-book rating aggregate, refreshed whenever a rating is saved"""
+    __tablename__ = 'book_stats'
+    
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    avg_score = db.Column(db.Float, nullable=False, index=True)
+    n_ratings = db.Column(db.Integer, nullable=False)
+
+class UserGenreStats(db.Model):
+    """Per-user, per-genre rating aggregate, refreshed whenever the user rates a book"""
+    __tablename__ = 'user_genre_stats'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    genre = db.Column(db.String(50), primary_key=True)
+    avg_score = db.Column(db.Float, nullable=False)
+    n_ratings = db.Column(db.Integer, nullable=False)
+
+# --- Search Index ---
+# Substring filters (ILIKE '%x%') cannot use a btree index. On SQLite a
+# trigram FTS5 table mirrors the searchable columns and is kept in sync by
+# triggers; on Postgres pg_trgm GIN indexes serve ILIKE directly.
+books_fts = table('books_fts', column('rowid'), column('title'), column('author'), column('genre'))
+
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, author, genre, content='books', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+    "INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, genre) "
+    "VALUES ('delete', old.id, old.title, old.author, old.genre); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, genre) "
+    "VALUES ('delete', old.id, old.title, old.author, old.genre); "
+    "INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre); END",
+]
+
+POSTGRES_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_books_author_trgm ON books USING gin (author gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_books_genre_trgm ON books USING gin (genre gin_trgm_ops)",
+]
+
 # --- Helper Functions ---
-def calculate_similarity(user1_id, user2_id):
-    """Calculate Pearson correlation between two users"""
-    user1_ratings = {r.book_id: r.score for r in Rating.query.filter_by(user_id=user1_id).all()}
-    user2_ratings = {r.book_id: r.score for r in Rating.query.filter_by(user_id=user2_id).all()}
-    
-    common_books = set(user1_ratings.keys()) & set(user2_ratings.keys())
-    n = len(common_books)
-    
-    if n < 3:  # Minimum 3 common ratings for meaningful similarity
-        return 0
-    
-    # Calculate Pearson correlation
-    sum1 = sum(user1_ratings[b] for b in common_books)
-    sum2 = sum(user2_ratings[b] for b in common_books)
-    sum1_sq = sum(pow(user1_ratings[b], 2) for b in common_books)
-    sum2_sq = sum(pow(user2_ratings[b], 2) for b in common_books)
-    p_sum = sum(user1_ratings[b] * user2_ratings[b] for b in common_books)
-    
-    num = p_sum - (sum1 * sum2 / n)
-    den = ((sum1_sq - pow(sum1, 2)/n) * (sum2_sq - pow(sum2, 2)/n)) ** 0.5
-    
-    return num / den if den != 0 else 0
-
-def get_user_preferred_genres(user_id, top_n=2):
-    """Get user's top preferred genres based on their ratings"""
-    genre_scores = db.session.query(
-        Book.genre,
-        db.func.avg(Rating.score).label('avg_rating'),
-        db.func.count(Rating.id).label('count')
-    ).join(Rating).filter(
-        Rating.user_id == user_id
-    ).group_by(Book.genre).all()
-    
-    if not genre_scores:
-        return None
-    
-    # Sort by average rating (weighted by number of ratings)
-    preferred = sorted(
-        genre_scores,
-        key=lambda x: (x.avg_rating * min(x.count, 5)),  # Cap influence of many ratings
-        reverse=True
+def upsert(model):
+    """INSERT statement for the active dialect, supporting on_conflict_do_update"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def refresh_book_stats(book_ids=None):
+    """Recompute BookStats for the given book ids (or a SELECT of them); None means all
+    
+    Existing rows for those books are cleared first, so a book whose last
+    rating was deleted loses its stats instead of keeping stale ones.
+    """
+    stale = delete(BookStats)
+    aggregate = select(
+        Rating.book_id, func.avg(Rating.score), func.count(Rating.id)
+    ).group_by(Rating.book_id)
+    if book_ids is not None:
+        stale = stale.where(BookStats.book_id.in_(book_ids))
+        aggregate = aggregate.where(Rating.book_id.in_(book_ids))
+    db.session.execute(stale)
+    
+    stmt = upsert(BookStats).from_select(['book_id', 'avg_score', 'n_ratings'], aggregate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[BookStats.book_id],
+        set_={'avg_score': stmt.excluded.avg_score, 'n_ratings': stmt.excluded.n_ratings}
+    )
+    db.session.execute(stmt)
+
+def refresh_user_genre_stats(user_ids=None, genres=None):
+    """Recompute UserGenreStats for the given users and genres (ids, names or SELECTs); None means all
+    
+    Existing rows for those keys are cleared first, so a user left with no
+    ratings in a genre loses that genre instead of keeping a stale row.
+    """
+    stale = delete(UserGenreStats)
+    aggregate = select(
+        Rating.user_id, Book.genre, func.avg(Rating.score), func.count(Rating.id)
+    ).join(Book).group_by(Rating.user_id, Book.genre)
+    if user_ids is not None:
+        stale = stale.where(UserGenreStats.user_id.in_(user_ids))
+        aggregate = aggregate.where(Rating.user_id.in_(user_ids))
+    if genres is not None:
+        stale = stale.where(UserGenreStats.genre.in_(genres))
+        aggregate = aggregate.where(Book.genre.in_(genres))
+    db.session.execute(stale)
+    
+    stmt = upsert(UserGenreStats).from_select(['user_id', 'genre', 'avg_score', 'n_ratings'], aggregate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserGenreStats.user_id, UserGenreStats.genre],
+        set_={'avg_score': stmt.excluded.avg_score, 'n_ratings': stmt.excluded.n_ratings}
     )
-    return [g.genre for g in preferred[:top_n]]
+    db.session.execute(stmt)
+
+def create_search_index():
+    """Create the substring search index for the active dialect"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        for ddl in POSTGRES_SEARCH_DDL:
+            db.session.execute(text(ddl))
+    elif dialect == 'sqlite':
+        existed = books_fts_available()
+        try:
+            for ddl in SQLITE_SEARCH_DDL:
+                db.session.execute(text(ddl))
+        except OperationalError:
+            # SQLite older than 3.34 has no trigram tokenizer; keep plain ILIKE
+            db.session.rollback()
+            return
+        if not existed:
+            db.session.execute(text("INSERT INTO books_fts(books_fts) VALUES ('rebuild')"))
+            books_fts_available.cache_clear()
+    db.session.commit()
+
+@lru_cache(maxsize=1)
+def books_fts_available():
+    """Whether the SQLite books_fts table exists in this database"""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    return db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'")
+    ).first() is not None
+
+def trigram_searchable(term):
+    """Whether a filter term can be served by the trigram index
+    
+    Terms shorter than a trigram or containing LIKE wildcards cannot use the
+    index, and SQLite 3.40's FTS5 crashes when such a pattern is combined
+    with an indexed one, so those stay on plain ILIKE.
+    """
+    return len(term) >= 3 and '%' not in term and '_' not in term
+
+def load_ratings_matrix():
+    """Load every rating in one query as a sparse users x books matrix
+    
+    Returns (M, user_ids, book_ids) where M is a CSR matrix of scores and
+    row/column i corresponds to user_ids[i]/book_ids[i].
+    """
+    # Stream rows from the cursor in batches so only one batch of Row objects
+    # is alive at a time; each batch is packed straight into an int array.
+    # Rows arrive in (user_id, book_id) order straight off ix_ratings_covering
+    result = db.session.execute(
+        select(Rating.user_id, Rating.book_id, Rating.score).order_by(
+            Rating.user_id, Rating.book_id
+        ).execution_options(yield_per=5000)
+    )
+    batches = [np.array(batch, dtype=np.int64).reshape(-1, 3) for batch in result.partitions()]
+    users, books, scores = np.concatenate(batches or [np.empty((0, 3), dtype=np.int64)]).T
+    user_ids, user_counts = np.unique(users, return_counts=True)
+    book_ids, book_idx = np.unique(books, return_inverse=True)
+    
+    # Sorted input is already CSR layout: each user's ratings are one
+    # contiguous run with ascending columns, so no COO sort/merge is needed
+    indptr = np.concatenate([[0], np.cumsum(user_counts)])
+    M = csr_matrix(
+        (scores.astype(np.float32), book_idx, indptr),
+        shape=(len(user_ids), len(book_ids))
+    )
+    return M, user_ids, book_ids
+
+def similarity_operands(M):
+    """Matrices calculate_similarity needs besides M itself: the rated-book
+    indicator and the squared scores. Neither depends on the target user, so
+    callers build them once per ratings matrix"""
+    # Same sparsity pattern as M, so share its index arrays rather than copy them
+    rated = csr_matrix((np.ones_like(M.data), M.indices, M.indptr), shape=M.shape)
+    squares = csr_matrix((M.data * M.data, M.indices, M.indptr), shape=M.shape)
+    return rated, squares
+
+def calculate_similarity(M, rated, squares, u):
+    """Calculate Pearson correlation between row u of M and every row, over co-rated books
+    
+    Multiplying by the target's scores (x) and rated-book indicator (b)
+    restricts every per-user sum to the books both users rated.
+    """
+    # Keep the target vectors in M's float32: scores are small integers, so
+    # the sums are exact in float32, and a float64 operand would make every
+    # product upcast-copy the matrix data. Only the final formula runs in float64
+    x = M[u].toarray().ravel()
+    b = (x > 0).astype(x.dtype)
+    
+    n, sum1, sum1_sq = (rated @ np.column_stack([b, x, x * x])).T.astype(np.float64)
+    sum2, p_sum = (M @ np.column_stack([b, x])).T.astype(np.float64)
+    sum2_sq = (squares @ b).astype(np.float64)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        num = p_sum - (sum1 * sum2 / n)
+        den = np.sqrt((sum1_sq - sum1 * sum1 / n) * (sum2_sq - sum2 * sum2 / n))
+        # Minimum 3 common ratings for meaningful similarity
+        similarity = np.where((n >= 3) & (den > 0), num / den, 0)
+    
+    similarity[u] = 0  # A user is not their own neighbour
+    return similarity
+
+def top_neighbours(similarity, k=5, threshold=0.3):
+    """Indices of the k highest similarities above threshold, best first"""
+    candidates = np.flatnonzero(similarity > threshold)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(similarity[candidates], -k)[-k:]]
+    return candidates[np.argsort(similarity[candidates])[::-1]]
+
+def preferred_genres_query(user_id, top_n=2):
+    """SELECT of the user's top preferred genres based on their ratings"""
+    count = UserGenreStats.n_ratings
+    return select(UserGenreStats.genre).where(
+        UserGenreStats.user_id == user_id
+    ).order_by(
+        # Average rating weighted by number of ratings, capping the influence of many ratings
+        (UserGenreStats.avg_score * case((count > 5, 5), else_=count)).desc()
+    ).limit(top_n)
+
+def user_exists(column, value):
+    """Check for a user with column == value via SELECT EXISTS, without loading the row"""
+    # lambda_stmt caches the built statement per column, so repeat calls only bind value
+    return db.session.execute(lambda_stmt(lambda: select(exists().where(column == value)))).scalar()
+
+def verify_password(password_hash, password):
+    """Check a password against its Argon2 hash"""
+    if not password_hash:
+        return False
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        # Wrong password, or a legacy plaintext value that is not a hash
+        return False
+
+# --- Data Versions ---
+# Tokens naming the current snapshot of the catalog and of the ratings. They
+# key the similarity cache, the /books response cache and ETags, and live in
+# the shared cache backend so a write through one worker invalidates them in
+# every worker
+CATALOG_VERSION_KEY = 'catalog_version'
+RATINGS_VERSION_KEY = 'ratings_version'
+
+# Tokens are random, so an expired one is replaced by a fresh one, never an
+# old one. Shared tokens expire to recover from a bump lost to a Redis outage;
+# process-local ones (SimpleCache) cannot miss a bump, so they never expire
+# and cached data is only rebuilt after a write
+VERSION_TIMEOUT = 3600 if app.config['CACHE_TYPE'] == 'RedisCache' else 0
+
+if app.config['CACHE_TYPE'] != 'RedisCache' and 'gunicorn' in os.environ.get('SERVER_SOFTWARE', ''):
+    # Each worker would keep its own tokens and never see writes made
+    # through the others
+    app.logger.warning(
+        "REDIS_URL is not set: with more than one gunicorn worker, cached "
+        "responses and recommendations go stale after writes through other workers"
+    )
+
+def data_version(key):
+    """Current version token for key, or None while the cache backend is unreachable
+    
+    Memoized for the request, so the ETag, response cache and view agree.
+    """
+    versions = g.setdefault('data_versions', {})
+    if key not in versions:
+        try:
+            version = cache.get(key)
+            if version is None:
+                # First use or expired: start a fresh version so nothing older is reused
+                cache.add(key, uuid.uuid4().hex, timeout=VERSION_TIMEOUT)
+                version = cache.get(key)
+        except CACHE_BACKEND_ERRORS as error:
+            app.logger.warning("Cache backend unavailable; serving %s unversioned: %s", key, error)
+            version = None
+        versions[key] = version
+    return versions[key]
+
+def bump_data_version(key):
+    """Invalidate everything cached under the key's current version"""
+    version = uuid.uuid4().hex
+    try:
+        cache.set(key, version, timeout=VERSION_TIMEOUT)
+    except CACHE_BACKEND_ERRORS as error:
+        # The write itself is already committed; don't fail it over the cache
+        app.logger.warning("Cache backend unavailable; could not bump %s: %s", key, error)
+        version = None
+    g.setdefault('data_versions', {})[key] = version
+
+def mark_catalog_changed(session):
+    """Flag a session so that its next commit bumps the catalog version"""
+    session.info.setdefault('changed_versions', set()).add(CATALOG_VERSION_KEY)
+
+def mark_ratings_changed(session, user_id, book_id):
+    """Record a rating write so the session's next commit refreshes the book's
+    aggregates and bumps the ratings version"""
+    session.info.setdefault('rated_pairs', set()).add((user_id, book_id))
+    session.info.setdefault('changed_versions', set()).add(RATINGS_VERSION_KEY)
+
+@event.listens_for(Book, 'after_insert')
+@event.listens_for(Book, 'after_update')
+@event.listens_for(Book, 'after_delete')
+def book_flushed(mapper, connection, target):
+    mark_catalog_changed(object_session(target))
+
+@event.listens_for(Rating, 'after_insert')
+@event.listens_for(Rating, 'after_update')
+@event.listens_for(Rating, 'after_delete')
+def rating_flushed(mapper, connection, target):
+    """ORM writes to ratings are picked up at commit like those in add_rating"""
+    session = object_session(target)
+    mark_ratings_changed(session, target.user_id, target.book_id)
+    # A rating moved to another user or book also changes the old pair's aggregates
+    state = inspect(target)
+    old_user_id = state.attrs.user_id.history.deleted
+    old_book_id = state.attrs.book_id.history.deleted
+    if old_user_id or old_book_id:
+        mark_ratings_changed(
+            session,
+            old_user_id[0] if old_user_id else target.user_id,
+            old_book_id[0] if old_book_id else target.book_id
+        )
+
+@event.listens_for(db.session, 'before_commit')
+def refresh_stats_before_commit(session):
+    # Flush first so pending Rating objects report themselves
+    session.flush()
+    pairs = session.info.pop('rated_pairs', None)
+    if not pairs:
+        return
+    user_ids = sorted({user_id for user_id, _ in pairs})
+    book_ids = sorted({book_id for _, book_id in pairs})
+    # Recompute rather than adjust running averages, so no drift survives a
+    # missed write; the refresh reads the (book_id, score) covering index
+    refresh_book_stats(book_ids)
+    refresh_user_genre_stats(user_ids, select(Book.genre).where(Book.id.in_(book_ids)))
+
+@event.listens_for(db.session, 'after_commit')
+def bump_after_commit(session):
+    for key in session.info.pop('changed_versions', ()):
+        bump_data_version(key)
+
+@event.listens_for(db.session, 'after_rollback')
+def reset_after_rollback(session):
+    session.info.pop('rated_pairs', None)
+    session.info.pop('changed_versions', None)
+
+def versioned_etag(*keys):
+    """Tag GET responses with the given data versions, answering a matching
+    If-None-Match with 304 before the view touches the database"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            # Read the versions before the view so a concurrent write can only
+            # make the tag older than the body, never newer
+            versions = [data_version(key) for key in keys]
+            if None in versions:
+                # Unversioned: let the body-hash ETag in add_etag handle it
+                return view(*args, **kwargs)
+            tokens = '|'.join([request.full_path, *versions])
+            etag = hashlib.blake2b(tokens.encode(), digest_size=16).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+def catalog_cache_key():
+    """Response cache key for catalog listings: path, sorted query args and catalog version"""
+    args = hashlib.md5(str(sorted(request.args.items(multi=True))).encode()).hexdigest()
+    return f"view/{request.path}/{data_version(CATALOG_VERSION_KEY)}/{args}"
+
+# --- Similarity Cache ---
+@lru_cache(maxsize=1)
+def load_ratings_index(version):
+    """Ratings matrix for one ratings version, plus a neighbour cache filled on demand"""
+    M, user_ids, book_ids = load_ratings_matrix()
+    rated, squares = similarity_operands(M)
+    return {
+        "matrix": M,
+        "rated": rated,
+        "squares": squares,
+        "user_ids": user_ids,
+        "book_ids": book_ids,
+        "rows": dict(zip(user_ids.tolist(), range(len(user_ids)))),
+        "neighbours": {}  # user_id -> [(user_id, similarity), ...]
+    }
+
+def get_similar_users(user_id):
+    """Get a user's top neighbours as (user_id, similarity) pairs, best first"""
+    version = data_version(RATINGS_VERSION_KEY)
+    if version is None:
+        # No version to key the cache on: build a one-off index
+        index = load_ratings_index.__wrapped__(version)
+    else:
+        index = load_ratings_index(version)
+    neighbours = index["neighbours"]
+    
+    if user_id not in neighbours:
+        row = index["rows"].get(user_id)
+        if row is None:
+            neighbours[user_id] = []
+        else:
+            similarity = calculate_similarity(index["matrix"], index["rated"], index["squares"], row)
+            top = top_neighbours(similarity)
+            neighbours[user_id] = list(zip(index["user_ids"][top].tolist(), similarity[top].tolist()))
+    
+    return neighbours[user_id]
 
 # --- Routes ---
 @app.route('/')
@@ -134,21 +596,56 @@ def home():
     })
 
 @app.route('/books', methods=['GET'])
+@versioned_etag(CATALOG_VERSION_KEY)
+@cache.cached(make_cache_key=catalog_cache_key,
+              unless=lambda: data_version(CATALOG_VERSION_KEY) is None)
 def get_books():
     """Get paginated list of books with optional filtering"""
     page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 50)
+    per_page = max(1, min(request.args.get('per_page', 10, type=int), 50))
     genre = request.args.get('genre')
     author = request.args.get('author')
     
-    query = Book.query
-    
-    if genre:
-        query = query.filter(Book.genre.ilike(f"%{genre}%"))
-    if author:
-        query = query.filter(Book.author.ilike(f"%{author}%"))
-    
-    books = query.paginate(page=page, per_page=per_page, error_out=False)
+    # Plain rows rather than Book instances: the listing only serializes
+    # these columns, so skip identity-map bookkeeping and unused columns
+    query = Book.query.with_entities(Book.id, Book.title, Book.author, Book.genre)
+    
+    # Trigram LIKE on the FTS table is case-insensitive, matching ILIKE
+    matches = select(books_fts.c.rowid)
+    use_index = False
+    
+    for name, term in (('genre', genre), ('author', author)):
+        if not term:
+            continue
+        if books_fts_available() and trigram_searchable(term):
+            matches = matches.where(books_fts.c[name].like(f"%{term}%"))
+            use_index = True
+        else:
+            query = query.filter(getattr(Book, name).ilike(f"%{term}%"))
+    
+    if use_index:
+        query = query.filter(Book.id.in_(matches))
+    
+    query = query.order_by(Book.id)
+    after_id = request.args.get('after_id', type=int)
+    
+    if after_id is not None:
+        # Keyset pagination: seek past the cursor on the primary key instead
+        # of scanning and discarding OFFSET rows; one extra row tells us
+        # whether another page follows
+        items = query.filter(Book.id > after_id).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        result = {}
+    else:
+        books = query.paginate(page=page, per_page=per_page, error_out=False)
+        items = books.items
+        has_more = books.has_next
+        result = {
+            "total": books.total,
+            "pages": books.pages,
+            "current_page": page
+        }
     
     return jsonify({
         "books": [{
@@ -156,18 +653,22 @@ def get_books():
             "title": book.title,
             "author": book.author,
             "genre": book.genre
-        } for book in books.items],
-        "total": books.total,
-        "pages": books.pages,
-        "current_page": page
+        } for book in items],
+        **result,
+        "next_cursor": items[-1].id if has_more else None
     })
 
 @app.route('/books/<int:book_id>', methods=['GET', 'PUT'])
+@versioned_etag(CATALOG_VERSION_KEY, RATINGS_VERSION_KEY)
 def book_detail(book_id):
     """Get or update a specific book"""
-    book = Book.query.get_or_404(book_id)
-    
     if request.method == 'GET':
+        # Book columns and the precomputed average rating, both primary key lookups
+        book = db.session.query(
+            Book.id, Book.title, Book.author, Book.genre, Book.description,
+            Book.published_year, BookStats.avg_score
+        ).outerjoin(BookStats).filter(Book.id == book_id).first_or_404()
+        
         return jsonify({
             "id": book.id,
             "title": book.title,
@@ -175,12 +676,12 @@ def book_detail(book_id):
             "genre": book.genre,
             "description": book.description,
             "published_year": book.published_year,
-            "average_rating": db.session.query(
-                db.func.avg(Rating.score)
-            ).filter_by(book_id=book_id).scalar() or 0
+            "average_rating": book.avg_score or 0
         })
     
     elif request.method == 'PUT':
+        book = Book.query.get_or_404(book_id)
+        
         data = request.get_json()
         if not data:
             return jsonify({"error": "No data provided"}), 400
@@ -190,8 +691,13 @@ def book_detail(book_id):
             book.title = data['title']
         if 'author' in data:
             book.author = data['author']
-        if 'genre' in data:
+        if 'genre' in data and data['genre'] != book.genre:
+            # Move this book's ratings between the raters' genre aggregates
+            genres = [book.genre, data['genre']]
+            raters = select(Rating.user_id).where(Rating.book_id == book_id)
             book.genre = data['genre']
+            db.session.flush()
+            refresh_user_genre_stats(raters, genres)
         if 'description' in data:
             book.description = data['description']
         if 'published_year' in data:
@@ -200,11 +706,30 @@ def book_detail(book_id):
         db.session.commit()
         return jsonify({"message": "Book updated successfully"})
 
+# Rounds of id sampling before /books/random settles for fewer books
+RANDOM_SAMPLE_ATTEMPTS = 3
+
 @app.route('/books/random', methods=['GET'])
 def random_books():
     """Get random selection of books"""
     count = min(request.args.get('count', 3, type=int), 10)
-    books = Book.query.order_by(func.random()).limit(count).all()
+    
+    # Sample ids from the primary key range instead of sorting the whole table;
+    # oversample so gaps left by deleted rows rarely leave us short, and retry
+    # a few times with fresh ids when they do
+    max_id = db.session.query(func.max(Book.id)).scalar() or 0
+    books, tried = [], set()
+    for _ in range(RANDOM_SAMPLE_ATTEMPTS):
+        missing = count - len(books)
+        if missing <= 0 or len(tried) >= max_id:
+            break
+        ids = set(random.sample(range(1, max_id + 1), min(missing * 3, max_id))) - tried
+        tried |= ids
+        found = db.session.execute(
+            select(Book.id, Book.title, Book.author, Book.genre).where(Book.id.in_(ids))
+        ).all()
+        # IN () comes back in index order; pick among the hits so low ids aren't favoured
+        books += random.sample(found, min(missing, len(found)))
     
     return jsonify({
         "books": [{
@@ -220,52 +745,43 @@ def random_books():
 def recommend_books(user_id):
     """Get personalized book recommendations for a user"""
     # Check user exists
-    user = User.query.get_or_404(user_id)
+    if not user_exists(User.id, user_id):
+        abort(404)
+    
+    # Content-based, collaborative and popular candidates come back from a
+    # single UNION ALL statement, tagged with their source
+    rated = select(Rating.book_id).where(Rating.user_id == user_id).cte('rated')
+    genres = preferred_genres_query(user_id).cte('preferred_genres')
+    columns = (Book.id, Book.title, Book.author, Book.genre)
+    
+    # Strategy 1: Content-based (preferred genres). Shuffle only the matching
+    # ids (served from the genre index), then load the five picked rows
+    content_ids = select(Book.id).where(
+        Book.genre.in_(select(genres.c.genre)),
+        Book.id.notin_(select(rated.c.book_id))
+    ).order_by(func.random()).limit(5)
+    content = select(*columns, literal_column("'content'").label('source')).where(Book.id.in_(content_ids))
     
-    # Strategy 1: Content-based (preferred genres)
-    preferred_genres = get_user_preferred_genres(user_id)
-    user_rated_books = {r.book_id for r in user.ratings}
+    # Strategy 2: Collaborative filtering
+    similar_user_ids = [uid for uid, _ in get_similar_users(user_id)]
+    collab_ids = select(Book.id).join(Rating).where(
+        Rating.user_id.in_(similar_user_ids),
+        Book.id.notin_(select(rated.c.book_id))
+    ).group_by(Book.id).order_by(
+        db.desc(db.func.avg(Rating.score))
+    ).limit(5)
+    collab = select(*columns, literal_column("'collab'").label('source')).where(Book.id.in_(collab_ids))
     
-    if preferred_genres:
-        content_recs = Book.query.filter(
-            Book.genre.in_(preferred_genres),
-            ~Book.id.in_(user_rated_books)
-        ).order_by(func.random()).limit(5).all()
-    else:
-        content_recs = []
+    # Fallback to popular books if no personalized recommendations
+    popular_ids = select(BookStats.book_id).order_by(BookStats.avg_score.desc()).limit(5)
+    popular = select(*columns, literal_column("'popular'").label('source')).where(Book.id.in_(popular_ids))
     
-    # Strategy 2: Collaborative filtering
-    all_users = User.query.filter(User.id != user_id).all()
-    similarities = []
-    
-    for other_user in all_users:
-        similarity = calculate_similarity(user_id, other_user.id)
-        if similarity > 0.3:  # Only consider meaningful similarities
-            similarities.append((other_user.id, similarity))
-    
-    # Sort by similarity and get top 5
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    similar_user_ids = [uid for uid, _ in similarities[:5]]
-    
-    if similar_user_ids:
-        collab_recs = db.session.query(Book).join(Rating).filter(
-            Rating.user_id.in_(similar_user_ids),
-            ~Book.id.in_(user_rated_books)
-        ).group_by(Book.id).order_by(
-            db.desc(db.func.avg(Rating.score))
-        ).limit(5).all()
-    else:
-        collab_recs = []
+    rows = db.session.execute(union_all(content, collab, popular)).all()
     
     # Combine and deduplicate recommendations
-    all_recs = {(b.id, b.title, b.author, b.genre) for b in content_recs + collab_recs}
-    
+    all_recs = {row[:4] for row in rows if row.source != 'popular'}
     if not all_recs:
-        # Fallback to popular books if no personalized recommendations
-        all_recs = db.session.query(Book).join(Rating).group_by(Book.id).order_by(
-            db.desc(db.func.avg(Rating.score))
-        ).limit(5).all()
-        all_recs = {(b.id, b.title, b.author, b.genre) for b in all_recs}
+        all_recs = {row[:4] for row in rows}
     
     return jsonify({
         "recommendations": [{
@@ -291,21 +807,23 @@ def add_rating():
     except (ValueError, TypeError):
         return jsonify({"error": "Score must be integer between 1-5"}), 400
     
-    user_id = get_jwt_identity()
+    user_id = int(get_jwt_identity())
     book_id = data['book_id']
     
     # Check if book exists
-    if not Book.query.get(book_id):
+    if not db.session.scalar(select(exists().where(Book.id == book_id))):
         return jsonify({"error": "Book not found"}), 404
     
-    # Update existing rating or create new one
-    rating = Rating.query.filter_by(user_id=user_id, book_id=book_id).first()
-    if rating:
-        rating.score = score
-    else:
-        rating = Rating(user_id=user_id, book_id=book_id, score=score)
-        db.session.add(rating)
-    
+    # Update existing rating or create new one in a single atomic statement
+    stmt = upsert(Rating).values(user_id=user_id, book_id=book_id, score=score)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Rating.user_id, Rating.book_id],
+        set_={'score': stmt.excluded.score}
+    )
+    db.session.execute(stmt)
+    # Core statements bypass the Rating mapper events, so record the write
+    # here; the commit refreshes BookStats and UserGenreStats for it
+    mark_ratings_changed(db.session, user_id, book_id)
     db.session.commit()
     return jsonify({"message": "Rating saved successfully"})
 
@@ -315,19 +833,21 @@ def add_rating():
 def register():
     """Register a new user"""
     data = request.get_json()
-    if not data or 'username' not in data or 'email' not in data or 'password' not in data:
+    fields = ('username', 'email', 'password')
+    if not isinstance(data, dict) or not all(field in data for field in fields):
         return jsonify({"error": "Missing required fields"}), 400
+    if not all(isinstance(data[field], str) for field in fields):
+        return jsonify({"error": "Username, email and password must be strings"}), 400
     
-    if User.query.filter_by(username=data['username']).first():
+    if user_exists(User.username, data['username']):
         return jsonify({"error": "Username already exists"}), 409
-    if User.query.filter_by(email=data['email']).first():
+    if user_exists(User.email, data['email']):
         return jsonify({"error": "Email already registered"}), 409
     
-    # In production: hash the password properly (e.g., using bcrypt)
     new_user = User(
         username=data['username'],
         email=data['email'],
-        password_hash=data['password']  # This is simplified - don't do this in production!
+        password_hash=password_hasher.hash(data['password'])
     )
     
     db.session.add(new_user)
@@ -336,22 +856,51 @@ def register():
     return jsonify({"message": "User created successfully"}), 201
 
 @app.route('/login', methods=['POST'])
+@limiter.limit("10/minute")
 def login():
     """Authenticate user and return JWT token"""
     data = request.get_json()
-    if not data or 'username' not in data or 'password' not in data:
+    fields = ('username', 'password')
+    if not isinstance(data, dict) or not all(field in data for field in fields):
         return jsonify({"error": "Missing username or password"}), 400
-    
-    user = User.query.filter_by(username=data['username']).first()
-    if not user or user.password_hash != data['password']:  # Simplified auth
+    if not all(isinstance(data[field], str) for field in fields):
+        return jsonify({"error": "Username and password must be strings"}), 400
+    
+    username = data['username']
+    user = db.session.scalars(lambda_stmt(lambda: select(User).where(User.username == username))).first()
+    if not user:
+        # Spend the same hashing time as a real check so response timing
+        # doesn't reveal which usernames exist
+        verify_password(DUMMY_PASSWORD_HASH, data['password'])
         return jsonify({"error": "Invalid credentials"}), 401
+    if not verify_password(user.password_hash, data['password']):
+        return jsonify({"error": "Invalid credentials"}), 401
+    
+    # Upgrade hashes made with older Argon2 parameters while we have the password
+    if password_hasher.check_needs_rehash(user.password_hash):
+        user.password_hash = password_hasher.hash(data['password'])
+        db.session.commit()
     
-    access_token = create_access_token(identity=user.id)
+    # JWT subjects must be strings; add_rating converts back to the user id
+    access_token = create_access_token(identity=str(user.id))
     return jsonify({
         "access_token": access_token,
         "user_id": user.id
     })
 
+# --- Response Hooks ---
+@app.after_request
+def add_etag(response):
+    """Tag successful GET responses so clients can revalidate with If-None-Match"""
+    if request.method != 'GET' or response.status_code != 200 or response.direct_passthrough:
+        return response
+    if response.get_etag()[0]:
+        # Already tagged from data versions by versioned_etag
+        return response
+    
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+    return response.make_conditional(request)
+
 # --- Error Handlers ---
 @app.errorhandler(404)
 def not_found(error):
@@ -367,18 +916,45 @@ def initialize_database():
     with app.app_context():
         db.create_all()
         
+        # create_all skips tables that already exist, so add any indexes
+        # introduced since the database was created
+        for tbl in db.metadata.sorted_tables:
+            for index in tbl.indexes:
+                index.create(db.engine, checkfirst=True)
+        create_search_index()
+        
         if not Book.query.first():
             sample_books = [
-                Book(title="The Great Gatsby", author="F. Scott Fitzgerald", genre="Classic"),
-                Book(title="To Kill a Mockingbird", author="Harper Lee", genre="Fiction"),
-                Book(title="1984", author="George Orwell", genre="Dystopian"),
-                Book(title="Pride and Prejudice", author="Jane Austen", genre="Romance"),
-                Book(title="The Catcher in the Rye", author="J.D. Salinger", genre="Coming-of-Age")
+                {"title": "The Great Gatsby", "author": "F. Scott Fitzgerald", "genre": "Classic"},
+                {"title": "To Kill a Mockingbird", "author": "Harper Lee", "genre": "Fiction"},
+                {"title": "1984", "author": "George Orwell", "genre": "Dystopian"},
+                {"title": "Pride and Prejudice", "author": "Jane Austen", "genre": "Romance"},
+                {"title": "The Catcher in the Rye", "author": "J.D. Salinger", "genre": "Coming-of-Age"}
             ]
-            db.session.add_all(sample_books)
+            # One executemany INSERT rather than a unit-of-work flush per object
+            db.session.execute(insert(Book), sample_books)
+            mark_catalog_changed(db.session)
             db.session.commit()
             print("Sample books added to database")
+        
+        # Backfill aggregates for databases created before the stats tables existed
+        if not BookStats.query.first():
+            refresh_book_stats()
+        if not UserGenreStats.query.first():
+            refresh_user_genre_stats()
+        db.session.commit()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables and indexes and add sample data"""
+    initialize_database()
 
 if __name__ == '__main__':
     initialize_database()
-    app.run(debug=True)
\ No newline at end of file
+    # The Werkzeug server is for development only; serve production traffic
+    # through gunicorn (see README)
+    if os.getenv('DEV'):
+        app.run(debug=True)
+    else:
+        print("Database ready. Start the API with: gunicorn -w 4 -k gthread --threads 4 app:app "
+              "(or set DEV=1 to use the development server)")
\ No newline at end of file